@@ -0,0 +1,190 @@
+"""
+音声のフィンガープリントで再放送の重複ダウンロードを判定する
+
+番組の一部区間のAACパケットのハッシュをフィンガープリントとする。
+パケットの中身はHLSストリームでも保存したm4aファイルでも同じなので、
+ダウンロード前のストリームと保存済みのファイルを比較できる
+
+保存済みのファイルのフィンガープリントは python fingerprint.py index で登録する
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from subprocess import DEVNULL, CalledProcessError, TimeoutExpired, check_output
+from typing import Dict, List, Optional, Set, Union
+
+from settings import DB_FILE, FINGERPRINT_OFFSET, FINGERPRINT_SECONDS, OUTBASEDIR, TMPOUTDIR, ffmpeg
+from util import FILENAME_PATTERN
+
+logger = logging.getLogger("fingerprint")
+
+# 比較する2つの区間のパケットの和集合のうちこの割合以上が一致すれば同じ番組とみなす
+MATCH_RATIO = 0.5
+# 無音や繰り返しの多い区間は異なるパケットが少なく別の番組とも一致しやすいので判定しない
+MIN_HASHES = 200
+QUERY_CHUNK_SIZE = 500
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS fingerprint_packets (
+    hash TEXT NOT NULL,
+    kouza TEXT NOT NULL,
+    date TIMESTAMP NOT NULL,
+    path TEXT NOT NULL
+)
+"""
+
+
+def connect() -> sqlite3.Connection:
+    con = sqlite3.connect(DB_FILE)
+    con.execute(CREATE_TABLE_SQL)
+    con.execute("CREATE INDEX IF NOT EXISTS fingerprint_packets_hash ON fingerprint_packets (hash)")
+    con.execute("CREATE INDEX IF NOT EXISTS fingerprint_packets_path ON fingerprint_packets (path)")
+    return con
+
+
+def fingerprint(source: Union[str, Path]) -> Optional[Set[str]]:
+    """
+    ストリームのURLまたはファイルのフィンガープリントを計算する。
+
+    ffmpegで区間のパケットを取り出してframemd5でハッシュを取る。
+    HLS(MPEG-TS)のADTSヘッダはaac_adtstoascで取り除くのでm4aファイルと同じハッシュになる。
+    ストリームの場合はシークした区間のセグメントだけを取得する。計算できなければNoneを返す
+    """
+    if FINGERPRINT_SECONDS <= 0:
+        return None
+    cmd_args = [
+        ffmpeg,
+        "-v",
+        "error",
+        "-ss",
+        str(FINGERPRINT_OFFSET),
+        "-i",
+        str(source),
+        "-t",
+        str(FINGERPRINT_SECONDS),
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        "-bsf:a",
+        "aac_adtstoasc",
+        "-f",
+        "framemd5",
+        "-",
+    ]
+    try:
+        output = check_output(cmd_args, stderr=DEVNULL, timeout=60)
+    except (CalledProcessError, TimeoutExpired) as e:
+        logger.warning(f"フィンガープリントの取得に失敗しました：{e}")
+        return None
+    # framemd5の各行は stream, dts, pts, duration, size, hash
+    hashes = {
+        line.split(",")[-1].strip()
+        for line in output.decode("ascii", errors="ignore").splitlines()
+        if line and not line.startswith("#")
+    }
+    return hashes if len(hashes) > 0 else None
+
+
+def find_duplicate(hashes: Set[str], exclude: Optional[Path] = None) -> Optional[Path]:
+    """
+    フィンガープリントが一致する保存済みファイルを探す(excludeは対象外とする)
+
+    一致したパケット数を両方の区間のパケットの和集合の数で割った割合で比較する。
+    異なるパケットがMIN_HASHESより少ない区間は判定しない
+    """
+    if len(hashes) < MIN_HASHES:
+        logger.info(f"フィンガープリントのパケットが少ないため重複を判定しません：{len(hashes)}")
+        return None
+    counts: Counter = Counter()
+    con = connect()
+    # SQLiteのパラメータ数の上限を超えないよう分割して問い合わせる
+    hash_list = sorted(hashes)
+    for i in range(0, len(hash_list), QUERY_CHUNK_SIZE):
+        chunk = hash_list[i:i + QUERY_CHUNK_SIZE]
+        counts.update(
+            dict(
+                con.execute(
+                    "SELECT path, COUNT(*) FROM fingerprint_packets WHERE hash IN ({}) GROUP BY path".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk,
+                ).fetchall()
+            )
+        )
+    # 和集合の割合がMATCH_RATIOに届く可能性のあるファイルだけ登録されたパケット数を取得する
+    candidates = [path for path, count in counts.items() if count >= len(hashes) * MATCH_RATIO]
+    sizes: Dict[str, int] = {}
+    for i in range(0, len(candidates), QUERY_CHUNK_SIZE):
+        chunk = candidates[i:i + QUERY_CHUNK_SIZE]
+        sizes.update(
+            con.execute(
+                "SELECT path, COUNT(*) FROM fingerprint_packets WHERE path IN ({}) GROUP BY path".format(
+                    ",".join("?" * len(chunk))
+                ),
+                chunk,
+            ).fetchall()
+        )
+    con.close()
+    scores = {path: counts[path] / (len(hashes) + sizes[path] - counts[path]) for path in candidates}
+    for path, score in sorted(scores.items(), key=lambda x: x[1], reverse=True):
+        if score < MATCH_RATIO:
+            break
+        if Path(path) != exclude and Path(path).is_file():
+            return Path(path)
+    return None
+
+
+def record_fingerprint(hashes: Set[str], kouzaname: str, date: datetime, path: Path) -> None:
+    with connect() as con:
+        con.execute("DELETE FROM fingerprint_packets WHERE path=?", (str(path),))
+        con.executemany(
+            "INSERT INTO fingerprint_packets (hash, kouza, date, path) VALUES (?, ?, ?, ?)",
+            [(h, kouzaname, date.strftime("%Y-%m-%d %H:%M:%S"), str(path)) for h in hashes],
+        )
+    con.close()
+
+
+def update_fingerprint_path(old: Path, new: Path) -> None:
+    """ファイルを移動したときに保存先を更新する"""
+    with connect() as con:
+        con.execute("UPDATE fingerprint_packets SET path=? WHERE path=?", (str(new), str(old)))
+    con.close()
+
+
+def index_archive(force: bool = False) -> None:
+    """保存済みのファイルのうち未登録のもののフィンガープリントを登録する"""
+    con = connect()
+    indexed = {path for (path,) in con.execute("SELECT DISTINCT path FROM fingerprint_packets")}
+    con.close()
+
+    files: List[Path] = sorted(OUTBASEDIR.glob("*/*/*.m4a")) + sorted(TMPOUTDIR.glob("*.m4a"))
+    count = 0
+    for audiofile in files:
+        m = FILENAME_PATTERN.match(audiofile.name)
+        if m is None or (not force and str(audiofile) in indexed):
+            continue
+        hashes = fingerprint(audiofile)
+        if hashes is None:
+            continue
+        record_fingerprint(hashes, m.group("kouza"), datetime.strptime(m.group("date"), "%Y_%m_%d"), audiofile)
+        count += 1
+    logger.info(f"indexed files = {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="fingerprint",
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("command", choices=["index"], help="index: 保存済みのファイルのフィンガープリントを登録する")
+    parser.add_argument("--force", action="store_true", help="登録済みのファイルも計算し直す")
+    args = parser.parse_args()
+
+    index_archive(force=args.force)
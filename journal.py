@@ -0,0 +1,134 @@
+"""
+番組ごとの処理状況を記録するジャーナル
+
+状態は planned → downloading → downloaded → tagged → finalized の順に進み、
+中断した実行は次回の実行で finalized になっていない番組だけを再開する
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from settings import JOURNAL_FILE
+from util import dict_factory
+
+STATES = ("planned", "downloading", "downloaded", "tagged", "finalized")
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS journal (
+    kouza TEXT NOT NULL,
+    date TIMESTAMP NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (kouza, date)
+)
+"""
+
+
+class RunJournal:
+    def __init__(self, path: Path = JOURNAL_FILE):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(path)
+        self.con.row_factory = dict_factory
+        with self.con:
+            self.con.execute(CREATE_TABLE_SQL)
+
+    @staticmethod
+    def _key(kouzaname: str, date: datetime) -> tuple[str, str]:
+        return kouzaname, date.strftime("%Y-%m-%d %H:%M:%S")
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.now().isoformat(" ", "seconds")
+
+    def get_state(self, kouzaname: str, date: datetime) -> Optional[str]:
+        row = self.con.execute(
+            "SELECT state FROM journal WHERE kouza=? AND date=?", self._key(kouzaname, date)
+        ).fetchone()
+        return None if row is None else row["state"]
+
+    def plan(self, kouzaname: str, date: datetime) -> None:
+        """未登録の番組をplannedとして登録する"""
+        with self.con:
+            self.con.execute(
+                "INSERT OR IGNORE INTO journal (kouza, date, state, updated_at) VALUES (?, ?, ?, ?)",
+                (*self._key(kouzaname, date), "planned", self._now()),
+            )
+
+    def set_state(self, kouzaname: str, date: datetime, state: str) -> None:
+        """状態を更新する。downloadingに更新したときは試行回数を数える"""
+        if state not in STATES:
+            raise ValueError(f"不正な状態です：{state}")
+        with self.con:
+            self.con.execute(
+                "UPDATE journal SET state=?, attempts=attempts+?, error=NULL, updated_at=?"
+                " WHERE kouza=? AND date=?",
+                (state, int(state == "downloading"), self._now(), *self._key(kouzaname, date)),
+            )
+
+    def set_error(self, kouzaname: str, date: datetime, error: Any) -> None:
+        """状態はそのままでエラー内容を記録する"""
+        with self.con:
+            self.con.execute(
+                "UPDATE journal SET error=?, updated_at=? WHERE kouza=? AND date=?",
+                (str(error), self._now(), *self._key(kouzaname, date)),
+            )
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """講座ごと・状態ごとの件数"""
+        return self.con.execute(
+            "SELECT kouza, state, COUNT(*) AS count FROM journal GROUP BY kouza, state ORDER BY kouza"
+        ).fetchall()
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        return self.con.execute(
+            "SELECT * FROM journal WHERE state != 'finalized' ORDER BY kouza, date"
+        ).fetchall()
+
+    def resumable(self) -> List[Dict[str, Any]]:
+        """ダウンロード済みのファイルを再利用できる番組"""
+        return self.con.execute(
+            "SELECT * FROM journal WHERE state IN ('downloaded', 'tagged') ORDER BY kouza, date"
+        ).fetchall()
+
+    def expire(self, before: datetime) -> List[Dict[str, Any]]:
+        """放送日がbeforeより前の未完了の番組を削除して返す"""
+        date = before.strftime("%Y-%m-%d %H:%M:%S")
+        with self.con:
+            rows = self.con.execute(
+                "SELECT * FROM journal WHERE state != 'finalized' AND date < ? ORDER BY kouza, date", (date,)
+            ).fetchall()
+            self.con.execute("DELETE FROM journal WHERE state != 'finalized' AND date < ?", (date,))
+        return rows
+
+    def close(self) -> None:
+        self.con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="journal",
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("command", choices=["status"], help="status: 処理状況を表示する")
+    args = parser.parse_args()
+
+    journal = RunJournal()
+    counts: Dict[str, Dict[str, int]] = {}
+    for row in journal.summary():
+        counts.setdefault(row["kouza"], {})[row["state"]] = row["count"]
+    for kouzaname, state_counts in counts.items():
+        print(kouzaname + " " + ", ".join(f"{state}: {state_counts.get(state, 0)}" for state in STATES))
+
+    unfinished = journal.unfinished()
+    print(f"未完了：{len(unfinished)}")
+    for row in unfinished:
+        error = "" if row["error"] is None else f" error: {row['error']}"
+        print(f"  {row['kouza']} {row['date'][:10]} {row['state']} attempts: {row['attempts']}{error}")
+    journal.close()
@@ -0,0 +1,158 @@
+"""
+共有ディレクトリのリースファイルで複数ホスト間の講座の分担を調整する
+
+リースファイルはO_EXCLで作成するので同時に取得できるのは1ホストだけで、
+保持中はハートビートで有効期限を延長する。期限切れのリースは他のホストが取得できる
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from settings import LEASE_DIR, LEASE_TTL
+
+logger = logging.getLogger("lease")
+
+HOSTNAME = socket.gethostname()
+
+
+class Lease:
+    def __init__(self, name: str, lease_dir: Optional[Path] = LEASE_DIR, ttl: int = LEASE_TTL):
+        self.name = name
+        self.lease_dir = lease_dir
+        self.ttl = ttl
+        self.token = f"{HOSTNAME}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @property
+    def path(self) -> Path:
+        assert self.lease_dir is not None
+        return self.lease_dir / f"{self.name}.lease"
+
+    def _content(self) -> bytes:
+        return json.dumps({"owner": self.token, "host": HOSTNAME, "expires": time.time() + self.ttl}).encode()
+
+    def _read(self, path: Path) -> Optional[dict]:
+        """リースファイルを読む。書き込み途中などで読めない場合は更新時刻から期限を推定する"""
+        try:
+            with open(path, "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            try:
+                return {"owner": None, "host": None, "expires": path.stat().st_mtime + self.ttl}
+            except FileNotFoundError:
+                return None
+
+    def _create(self, content: Optional[bytes] = None) -> bool:
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._content() if content is None else content)
+        return True
+
+    def acquire(self) -> bool:
+        if self.lease_dir is None:
+            return True
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        if self._create():
+            return True
+
+        holder = self._read(self.path)
+        if holder is None:
+            return self._create()
+        if holder["expires"] > time.time():
+            return False
+
+        # 期限切れのリースを退避してから取得し直す。退避できるのは1ホストだけ
+        logger.warning(f"{holder['host']}の期限切れのリース'{self.name}'を取得します")
+        stale = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(self.path, stale)
+        except FileNotFoundError:
+            return self._create()
+        taken = self._read(stale)
+        if taken is not None and taken["expires"] > time.time():
+            # 退避する直前に他のホストが取得したリースだったので元に戻す
+            try:
+                os.link(stale, self.path)
+            except FileExistsError:
+                pass
+            except OSError:
+                # SMB/CIFSの共有ディレクトリなどハードリンクを作れない場合は同じ内容で作成し直す
+                self._create(stale.read_bytes())
+            stale.unlink()
+            return False
+        stale.unlink()
+        return self._create()
+
+    def renew(self) -> bool:
+        """有効期限を延長する。他のホストに取得されていたらlostにする"""
+        if self.lease_dir is None:
+            return True
+        holder = self._read(self.path)
+        # 期限切れのリースは他のホストが取得している途中かもしれないので延長しない
+        if holder is None or holder["owner"] != self.token or holder["expires"] <= time.time():
+            return self._lose()
+        tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.tmp")
+        tmp.write_bytes(self._content())
+        os.replace(tmp, self.path)
+        # 読んでから置き換えるまでの間に他のホストが取得した場合に備えて、置き換えた後も自分のリースか確認する
+        holder = self._read(self.path)
+        if holder is None or holder["owner"] != self.token:
+            return self._lose()
+        return True
+
+    def _lose(self) -> bool:
+        logger.error(f"リース'{self.name}'が失われました")
+        self.lost = True
+        return False
+
+    def release(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self.lease_dir is None or self.lost:
+            return
+        holder = self._read(self.path)
+        if holder is not None and holder["owner"] == self.token:
+            self.path.unlink()
+
+    def start_heartbeat(self) -> None:
+        if self.lease_dir is None:
+            return
+
+        def run():
+            while not self._stop.wait(self.ttl / 3):
+                if not self.renew():
+                    return
+
+        self._heartbeat = threading.Thread(target=run, name=f"lease-{self.name}", daemon=True)
+        self._heartbeat.start()
+
+
+@contextmanager
+def course_lease(kouzaname: str) -> Iterator[Optional[Lease]]:
+    """講座のリースを取得する。他のホストが処理中ならNoneを返す"""
+    lease = Lease(kouzaname)
+    if not lease.acquire():
+        yield None
+        return
+    lease.start_heartbeat()
+    try:
+        yield lease
+    finally:
+        lease.release()
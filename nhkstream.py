@@ -1,6 +1,7 @@
 # coding:utf-8
 from __future__ import annotations
 
+import argparse
 import logging
 import os
 import os.path
@@ -8,7 +9,7 @@ import shutil
 import sqlite3
 import time
 import urllib.request
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 from subprocess import STDOUT, CalledProcessError, TimeoutExpired, check_call
 from typing import Any, Dict, List, Optional, Tuple, Union
@@ -21,21 +22,31 @@ from mutagen import MutagenError
 from mutagen.mp4 import MP4, MP4Cover
 from sentry_sdk.integrations.logging import LoggingIntegration
 
+from fingerprint import find_duplicate, fingerprint, record_fingerprint
+from journal import RunJournal
+from lease import HOSTNAME, Lease, course_lease
+from profiling import default_report_dir, profiler
 from settings import (
     DB_FILE,
     IMGURL,
+    JOURNAL_EXPIRE_DAYS,
     JSONURL,
     KOUZALIST,
     OUTBASEDIR,
     SENTRY_DSN_KEY,
+    STAGING_IN_MEMORY,
     TMPBASEDIR,
     TMPOUTDIR,
     ffmpeg,
 )
-from util import dict_factory
+from staging import StagingBuffer
+from util import dict_factory, move_file
 
 logger = logging.getLogger("nhkstream")
 
+# 複数ホストで実行しても衝突しないよう作業ディレクトリはホストごとに分ける
+TMPDIR = TMPBASEDIR / "nhkdump" / HOSTNAME
+
 
 # mp4ファイルにタグを保存する
 def settag(
@@ -82,7 +93,7 @@ def settag(
         audio.tags["\xa9gen"] = genre
     if year is not None:
         audio.tags["\xa9day"] = str(year)
-    audio.save()
+    audio.save(mp4file)
 
 
 class ondemandParser:
@@ -169,6 +180,14 @@ def get_textbook_volume(
     return textbook_year, textbook_month
 
 
+def get_total_track_num(kouzaname: str, month: int) -> int:
+    """テキスト1冊あたりのトータルトラック数"""
+    if kouzaname == "英会話タイムトライアル" and month == 5:
+        # 英会話タイムトライアルは5月は他講座より再放送が1週少ない
+        return 5 * 3
+    return 5 * 4
+
+
 def get_img_url(
     textbook_year: int, textbook_month: int, textbook_id_format: str
 ) -> str:
@@ -190,12 +209,65 @@ def get_img_url(
     return url
 
 
+def get_img_file(
+    textbook_year: int, textbook_month: int, textbook_id_format: str | None, outdir: Path
+) -> Path | None:
+    """ジャケット画像ファイルを取得する。取得できなければNoneを返す"""
+    if textbook_id_format is None:
+        return None
+    try:
+        img_url = get_img_url(textbook_year, textbook_month, textbook_id_format)
+        img_file = outdir / os.path.basename(img_url)
+        img_data = urllib.request.urlopen(img_url)
+        with open(img_file, "wb") as f:
+            f.write(img_data.read())
+        img_data.close()
+    except (urllib.error.HTTPError, urllib.error.URLError):
+        logger.warning("ジャケット画像の取得に失敗しました。ジャケット画像なしで保存します。")
+        return None
+    return img_file
+
+
+def get_tmpfile(kouzaname: str, date: datetime) -> Path:
+    """ダウンロードしたファイルの作業ディレクトリでのパス"""
+    return TMPDIR / "{kouza}_{date}.m4a".format(kouza=kouzaname, date=date.strftime("%Y_%m_%d"))
+
+
+def clean_tmpdir(journal: RunJournal) -> None:
+    """
+    作業ディレクトリのファイルのうち、中断した番組の再開に使うもの以外を削除する
+
+    ジャケット画像、タイムアウトなどで書きかけのまま残ったファイルが対象。
+    聴き逃し配信の期間が終わって再開できなくなった番組はジャーナルから削除し、ファイルも削除する
+    """
+    for row in journal.expire(datetime.now() - timedelta(days=JOURNAL_EXPIRE_DAYS)):
+        logger.info(f"{row['kouza']} {row['date'][:10]}は配信期間が終わったため再開しません({row['state']})")
+    if not TMPDIR.is_dir():
+        return
+    keep = {
+        get_tmpfile(row["kouza"], datetime.strptime(row["date"], "%Y-%m-%d %H:%M:%S"))
+        for row in journal.resumable()
+    }
+    for file in TMPDIR.iterdir():
+        if file in keep:
+            continue
+        if file.is_dir():
+            shutil.rmtree(file)
+        else:
+            file.unlink()
+
+
 # メイン関数
 def streamedump(
-    kouzaname: str, site_id: str, textbook_id_format: str | None, weekdays: list[int] | None,
+    kouzaname: str,
+    site_id: str,
+    textbook_id_format: str | None,
+    weekdays: list[int] | None,
+    lease: Lease | None = None,
 ) -> None:
     # ファイル名と放送日リストの取得
-    oparser = ondemandParser(site_id, weekdays=weekdays)
+    with profiler.stage("ondemand"):
+        oparser = ondemandParser(site_id, weekdays=weekdays)
     mp4url_list = oparser.get_mp4url_list()
     date_list = oparser.get_date_list()
 
@@ -203,23 +275,32 @@ def streamedump(
     con = sqlite3.connect(DB_FILE)
     con.row_factory = dict_factory
 
+    # 前回の実行で中断した番組を再開するためのジャーナル
+    journal = RunJournal()
+
     # mp4ファイルをダウンロードする
+    # 中断した番組のダウンロード済みファイルを再利用するため作業ディレクトリは削除しない
     FNULL = open(os.devnull, "w")
-    TMPDIR = TMPBASEDIR / "nhkdump"
-    if TMPDIR.is_dir():
-        shutil.rmtree(TMPDIR, ignore_errors=True)
-    TMPDIR.mkdir(parents=True)
+    TMPDIR.mkdir(parents=True, exist_ok=True)
     for mp4url, date in zip(mp4url_list, date_list):
+        # リースが他のホストに取得されたらトラック番号が衝突しないよう中止する
+        if lease is not None and lease.lost:
+            raise CommandExecError(f"{kouzaname}のリースが失われました")
+
+        # 処理済みの番組はスキップ
+        journal.plan(kouzaname, date)
+        state = journal.get_state(kouzaname, date)
+        if state == "finalized":
+            continue
+        job = f"{kouzaname}_{date:%Y_%m_%d}"
+
         # トータルトラック数
-        if kouzaname == "英会話タイムトライアル" and date.month == 5:
-            # 英会話タイムトライアルは5月は他講座より再放送が1週少ない
-            total_track_num = 5 * 3
-        else:
-            total_track_num = 5 * 4
+        total_track_num = get_total_track_num(kouzaname, date.month)
 
-        textbook_year, textbook_month = get_textbook_volume(
-            kouzaname, date, total_track_num
-        )
+        with profiler.stage("get_textbook_volume", job=job):
+            textbook_year, textbook_month = get_textbook_volume(
+                kouzaname, date, total_track_num
+            )
         OUTDIR = OUTBASEDIR / kouzaname / f"{textbook_year:d}年{textbook_month:02d}月号"
         if not OUTDIR.is_dir():
             OUTDIR.mkdir(parents=True)
@@ -228,30 +309,15 @@ def streamedump(
         albumname = f"{kouzaname}{textbook_year:d}年{textbook_month:02d}月号"
 
         # トータルトラック数
-        if kouzaname == "英会話タイムトライアル" and textbook_month == 5:
-            # 英会話タイムトライアルは5月は他講座より再放送が1週少ない
-            total_track_num = 5 * 3
-        else:
-            total_track_num = 5 * 4
+        total_track_num = get_total_track_num(kouzaname, textbook_month)
 
         # 出力ディレクトリに存在するファイルの数からトラックナンバーを決定する
         audio_file_list = list(OUTDIR.glob("*.m4a"))
         audio_file_count = len(audio_file_list)
 
         # ジャケット画像ファイルを取得する
-        if textbook_id_format is not None:
-            try:
-                img_url = get_img_url(textbook_year, textbook_month, textbook_id_format)
-                img_file = TMPDIR / os.path.basename(img_url)
-                img_data = urllib.request.urlopen(img_url)
-                with open(img_file, "wb") as f:
-                    f.write(img_data.read())
-                img_data.close()
-            except (urllib.error.HTTPError, urllib.error.URLError):
-                logger.warning("ジャケット画像の取得に失敗しました。ジャケット画像なしで保存します。")
-                img_file = None
-        else:
-            img_file = None
+        with profiler.stage("get_img_file", job=job):
+            img_file = get_img_file(textbook_year, textbook_month, textbook_id_format, TMPDIR)
 
         # 番組表データベースに接続
         con = sqlite3.connect(DB_FILE)
@@ -279,9 +345,7 @@ def streamedump(
             else:
                 logger.error(e)
 
-        tmpfile = TMPDIR / "{kouza}_{date}.m4a".format(
-            kouza=kouzaname, date=date.strftime("%Y_%m_%d")
-        )
+        tmpfile = get_tmpfile(kouzaname, date)
 
         if reair:
             audiofile = TMPOUTDIR / "{kouza}_{date}.m4a".format(
@@ -295,85 +359,179 @@ def streamedump(
         logger.info(f"ダウンロード開始：{albumname}:{audiofile.name}")
         if audiofile in audio_file_list:
             audio_file_count = audio_file_count - 1
-        if audiofile.is_file():
+        # タグの設定や移動の途中で中断した番組は保存先のファイルを使わずにやり直す
+        if audiofile.is_file() and state not in ("downloaded", "tagged"):
             if audiofile.stat().st_size > 3000000:
                 logger.info(f"{audiofile.name} still exist. Skip")
+                journal.set_state(kouzaname, date, "finalized")
                 continue
-        success = False
-        try_count = 0
-        while not success:
-            try:
-                try_count += 1
-                cmd_args = [
-                    ffmpeg,
-                    "-y",
-                    "-i",
-                    mp4url,
-                    "-vn",
-                    "-acodec",
-                    "copy",
-                    str(tmpfile),
-                ]
-                check_call(cmd_args, stdout=FNULL, stderr=STDOUT, timeout=5 * 60)
-                success = True
-            except CalledProcessError as e:
-                if tmpfile.exists():
-                    tmpfile.unlink()
-                if try_count >= 3:
-                    # 3回失敗したらやめる
-                    logger.error("ストリーミングファイルのダウンロードに失敗しました．")
+        # 保存先へ移動した後に中断した番組はフィンガープリントを登録して完了にする
+        if state == "tagged" and not tmpfile.is_file() and audiofile.is_file():
+            logger.info(f"{audiofile.name}は保存済みのため完了にします")
+            hashes = fingerprint(audiofile)
+            if hashes is not None:
+                record_fingerprint(hashes, kouzaname, date, audiofile)
+            journal.set_state(kouzaname, date, "finalized")
+            continue
+        # 保存済みの番組と同じ内容ならダウンロードしない
+        # ダウンロード済みのファイルを再利用する場合はストリームを取得しない
+        resumed = state in ("downloaded", "tagged") and tmpfile.is_file()
+        hashes = None
+        if not resumed:
+            with profiler.stage("fingerprint", job=job):
+                hashes = fingerprint(mp4url)
+        duplicate = find_duplicate(hashes, exclude=audiofile) if hashes is not None else None
+        if duplicate is not None and reair:
+            logger.info(f"{audiofile.name}は{duplicate.name}と同じ内容のためスキップします")
+            journal.set_state(kouzaname, date, "finalized")
+            continue
+
+        # メモリ上で受け取る場合は作業ディレクトリのファイルの代わりにバッファを使う
+        staging = None
+        if resumed:
+            logger.info(f"{tmpfile.name}はダウンロード済みのため再利用します")
+        elif duplicate is not None:
+            logger.info(f"{duplicate.name}と同じ内容のためダウンロードせずにコピーします")
+            shutil.copyfile(duplicate, tmpfile)
+        else:
+            if STAGING_IN_MEMORY:
+                staging = StagingBuffer(tmpfile.with_suffix(".staging.m4a"))
+            success = False
+            try_count = 0
+            while not success:
+                try:
+                    try_count += 1
+                    journal.set_state(kouzaname, date, "downloading")
+                    cmd_args = [
+                        ffmpeg,
+                        "-y",
+                        "-i",
+                        mp4url,
+                        "-vn",
+                        "-acodec",
+                        "copy",
+                    ]
+                    # ffmpegのCPU時間はこの番組に計上する
+                    with profiler.stage("ffmpeg", job=job):
+                        if staging is None:
+                            check_call(cmd_args + [str(tmpfile)], stdout=FNULL, stderr=STDOUT, timeout=5 * 60)
+                        else:
+                            staging.run(cmd_args, timeout=5 * 60)
+                    success = True
+                except CalledProcessError as e:
+                    if tmpfile.exists():
+                        tmpfile.unlink()
+                    if try_count >= 3:
+                        # 3回失敗したらやめる
+                        logger.error("ストリーミングファイルのダウンロードに失敗しました．")
+                        journal.set_error(kouzaname, date, e)
+                        if staging is not None:
+                            staging.close()
+                        raise CommandExecError(e)
+                    else:
+                        # 失敗したら5秒待ってリトライ
+                        logger.info("'{}'のダウンロードに失敗．リトライします．".format(title))
+                        time.sleep(5)
+                except TimeoutExpired as e:
+                    if tmpfile.exists():
+                        tmpfile.unlink()
+                    logger.error("タイムアウトのためダウンロードを中止しました．")
+                    journal.set_error(kouzaname, date, e)
+                    if staging is not None:
+                        staging.close()
                     raise CommandExecError(e)
-                else:
-                    # 失敗したら5秒待ってリトライ
-                    logger.info("'{}'のダウンロードに失敗．リトライします．".format(title))
-                    time.sleep(5)
-            except TimeoutExpired as e:
-                logger.error("タイムアウトのためダウンロードを中止しました．")
-                raise CommandExecError(e)
 
         # ダウンロードが正常に完了しなかった場合はファイルを削除して中止
-        if tmpfile.is_file():
+        if staging is not None or tmpfile.is_file():
             if kouzaname == "英会話タイムトライアル":
                 # 英会話タイムトライアルは10分番組なのでサイズが小さい
                 default_size = 3500000
             else:
                 default_size = 5000000
-            if tmpfile.stat().st_size < default_size:
+            downloaded_size = staging.size if staging is not None else tmpfile.stat().st_size
+            if downloaded_size < default_size:
                 logger.error("ダウンロードが完了しませんでした．")
-                tmpfile.unlink()
+                journal.set_error(kouzaname, date, "ダウンロードが完了しませんでした")
+                if staging is not None:
+                    staging.close()
+                else:
+                    tmpfile.unlink()
                 continue
+        journal.set_state(kouzaname, date, "downloaded")
+
+        # タグを設定してから保存先へ移動するので、保存先に書きかけのファイルが見えることはない
+        with profiler.stage("settag", job=job):
+            settag(
+                tmpfile if staging is None else staging.fileobj(),
+                image=img_file,
+                title=title,
+                artist=artist,
+                album=albumname,
+                genre="Speech",
+                track_num=None if reair else audio_file_count + 1,
+                total_track_num=total_track_num,
+                year=textbook_year,
+                disc_num=1,
+                total_disc_num=1,
+            )
 
-        # 保存先にコピー
-        shutil.copyfile(tmpfile, audiofile)
-
-        # タグを設定
-        settag(
-            audiofile,
-            image=img_file,
-            title=title,
-            artist=artist,
-            album=albumname,
-            genre="Speech",
-            track_num=None if reair else audio_file_count + 1,
-            total_track_num=total_track_num,
-            year=textbook_year,
-            disc_num=1,
-            total_disc_num=1,
-        )
+        journal.set_state(kouzaname, date, "tagged")
 
+        # 保存先に移動する(メモリ上で受け取った場合はバッファを書き込む)
+        with profiler.stage("copy", job=job):
+            if staging is None:
+                move_file(tmpfile, audiofile)
+            else:
+                staging.save(audiofile)
+                staging.close()
+
+        # ストリームから計算していなければ保存したファイルから計算する
+        if hashes is None:
+            hashes = fingerprint(audiofile)
+        if hashes is not None:
+            record_fingerprint(hashes, kouzaname, date, audiofile)
+        journal.set_state(kouzaname, date, "finalized")
+
+    journal.close()
     con.close()
 
 
 if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(prog="nhkstream")
+    argparser.add_argument(
+        "--profile",
+        nargs="?",
+        const=default_report_dir(TMPBASEDIR),
+        type=Path,
+        help="処理段階ごとの計測結果を出力する(出力先を省略すると作業ディレクトリのprofile以下)",
+    )
+    args = argparser.parse_args()
+    if args.profile is not None:
+        profiler.enable(args.profile)
+
     if SENTRY_DSN_KEY is not None:
         sentry_logging = LoggingIntegration(
             level=logging.INFO,  # Capture info and above as breadcrumbs
             event_level=logging.ERROR,  # Send errors as events
         )
         sentry_sdk.init(dsn=SENTRY_DSN_KEY, integrations=[sentry_logging])
-    for kouzaname, site_id, booknum, weekdays in KOUZALIST:
-        try:
-            streamedump(kouzaname, site_id, booknum, weekdays)
-        except CommandExecError:
-            logger.info(kouzaname + "のダウンロードを中止")
-            pass
+    # 前回の実行で残った作業ファイルのうち再開に使わないものを削除する
+    journal = RunJournal()
+    clean_tmpdir(journal)
+    journal.close()
+
+    try:
+        for kouzaname, site_id, booknum, weekdays in KOUZALIST:
+            # 講座のリースを取得できたホストだけがダウンロードする
+            with course_lease(kouzaname) as lease:
+                if lease is None:
+                    logger.info(kouzaname + "は他のホストで処理中のためスキップ")
+                    continue
+                try:
+                    with profiler.course(kouzaname):
+                        streamedump(kouzaname, site_id, booknum, weekdays, lease=lease)
+                except CommandExecError:
+                    logger.info(kouzaname + "のダウンロードを中止")
+                    pass
+    finally:
+        profiler.write_report()
@@ -0,0 +1,136 @@
+"""
+処理段階ごとのCPU時間・経過時間・メモリ使用量のピークを計測する
+
+--profile オプションを指定したときだけ有効になり、無効なときは何もしない
+"""
+from __future__ import annotations
+
+import cProfile
+import csv
+import logging
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Windowsにはresourceモジュールがないので子プロセスのCPU時間は計測しない
+    resource = None  # type: ignore
+
+logger = logging.getLogger("profiling")
+
+COLUMNS = ["stage", "course", "job", "wall", "cpu", "child_cpu", "mem_peak"]
+
+
+def child_cpu_time() -> float:
+    """終了した子プロセス(ffmpeg)のCPU時間の合計"""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler:
+    def __init__(self):
+        self.report_dir: Optional[Path] = None
+        self.records: List[Dict[str, object]] = []
+        self.course_name = ""
+
+    @property
+    def enabled(self) -> bool:
+        return self.report_dir is not None
+
+    def enable(self, report_dir: Path) -> None:
+        self.report_dir = report_dir
+        self.report_dir.mkdir(parents=True, exist_ok=True)
+        tracemalloc.start()
+        logger.info(f"プロファイル結果を{report_dir}に出力します")
+
+    @contextmanager
+    def stage(self, name: str, job: str = "") -> Iterator[None]:
+        """処理段階を計測する。子プロセスのCPU時間はjobに計上する"""
+        if not self.enabled:
+            yield
+            return
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        mem_start = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        child_cpu = child_cpu_time()
+        try:
+            yield
+        finally:
+            self.records.append(
+                {
+                    "stage": name,
+                    "course": self.course_name,
+                    "job": job,
+                    "wall": time.perf_counter() - wall,
+                    "cpu": time.process_time() - cpu,
+                    "child_cpu": child_cpu_time() - child_cpu,
+                    "mem_peak": max(tracemalloc.get_traced_memory()[1] - mem_start, 0),
+                }
+            )
+
+    @contextmanager
+    def course(self, name: str) -> Iterator[None]:
+        """講座ごとにcProfileの結果を保存する"""
+        if not self.enabled:
+            yield
+            return
+        assert self.report_dir is not None
+        self.course_name = name
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(self.report_dir / f"{name}.pstats")
+            self.course_name = ""
+
+    def write_report(self) -> None:
+        """計測結果を段階ごとの明細(stages.tsv)と集計(summary.tsv)に出力する"""
+        if not self.enabled:
+            return
+        assert self.report_dir is not None
+        with open(self.report_dir / "stages.tsv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        summary: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for record in self.records:
+            total = summary[str(record["stage"])]
+            total["count"] += 1
+            for key in ["wall", "cpu", "child_cpu"]:
+                total[key] += float(record[key])  # type: ignore
+            total["mem_peak"] = max(total["mem_peak"], float(record["mem_peak"]))  # type: ignore
+        with open(self.report_dir / "summary.tsv", "w", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(["stage", "count", "wall", "cpu", "child_cpu", "mem_peak"])
+            for stage, total in summary.items():
+                writer.writerow(
+                    [
+                        stage,
+                        int(total["count"]),
+                        f"{total['wall']:.3f}",
+                        f"{total['cpu']:.3f}",
+                        f"{total['child_cpu']:.3f}",
+                        int(total["mem_peak"]),
+                    ]
+                )
+        logger.info(f"プロファイル結果を出力しました：{self.report_dir}")
+
+
+def default_report_dir(basedir: Path) -> Path:
+    return basedir / "profile" / datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+profiler = Profiler()
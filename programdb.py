@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import argparse
 import logging
 import re
 import sqlite3
 from datetime import datetime
+from pathlib import Path
 from typing import Optional
 
 import jaconv
@@ -12,6 +14,7 @@ import requests
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import DAILY, rrule
 
+from profiling import default_report_dir, profiler
 from settings import (
     DB_FILE,
     NHK_APIKEY,
@@ -20,6 +23,7 @@ from settings import (
     NHK_PROGRAM_API,
     NHK_SERVICE,
     PROGRAMLIST,
+    TMPBASEDIR,
 )
 
 logger = logging.getLogger("programdb")
@@ -48,60 +52,78 @@ def getArtist(act: str) -> str:
     return jaconv.z2h(artist, kana=False, ascii=True)
 
 
+argparser = argparse.ArgumentParser(prog="programdb")
+argparser.add_argument(
+    "--profile",
+    nargs="?",
+    const=default_report_dir(TMPBASEDIR),
+    type=Path,
+    help="処理段階ごとの計測結果を出力する(出力先を省略すると作業ディレクトリのprofile以下)",
+)
+args = argparser.parse_args()
+if args.profile is not None:
+    profiler.enable(args.profile)
+
 # 翌日から1週間分の番組表から番組データを取得する
-json = []
-for date in rrule(
-    freq=DAILY, dtstart=datetime.today() + relativedelta(days=1), count=7
-):
-    r = requests.get(
-        NHK_PROGRAM_API.format(
-            area=NHK_AREA,
-            service=NHK_SERVICE,
-            genre=NHK_GENRE,
-            apikey=NHK_APIKEY,
-            date=date.strftime("%Y-%m-%d"),
+with profiler.stage("fetch"):
+    json = []
+    for date in rrule(
+        freq=DAILY, dtstart=datetime.today() + relativedelta(days=1), count=7
+    ):
+        r = requests.get(
+            NHK_PROGRAM_API.format(
+                area=NHK_AREA,
+                service=NHK_SERVICE,
+                genre=NHK_GENRE,
+                apikey=NHK_APIKEY,
+                date=date.strftime("%Y-%m-%d"),
+            )
         )
-    )
-    json.extend(r.json()["list"]["r2"])
+        json.extend(r.json()["list"]["r2"])
 
-df = pd.DataFrame(json)
-df = df.loc[:, ["start_time", "title", "act"]]
+with profiler.stage("transform"):
+    df = pd.DataFrame(json)
+    df = df.loc[:, ["start_time", "title", "act"]]
 
-# NHK番組表では英数字も全角なので半角へ置換し、全角スペースも半角スペースに置換
-df["title"] = df.title.apply(
-    lambda s: jaconv.z2h(s, kana=False, ascii=True, digit=True).replace("　", " ")
-)
+    # NHK番組表では英数字も全角なので半角へ置換し、全角スペースも半角スペースに置換
+    df["title"] = df.title.apply(
+        lambda s: jaconv.z2h(s, kana=False, ascii=True, digit=True).replace("　", " ")
+    )
 
-# 講座名とアーティスト名をmp3タグに設定する形式に変換する
-df["kouza"] = df.title.apply(getKouza)
-df["artist"] = df.act.apply(getArtist)
+    # 講座名とアーティスト名をmp3タグに設定する形式に変換する
+    df["kouza"] = df.title.apply(getKouza)
+    df["artist"] = df.act.apply(getArtist)
 
-# 時刻情報は不要なので日付情報のみに変換
-df["date"] = pd.to_datetime(df.start_time).apply(
-    lambda d: datetime(d.year, d.month, d.day)
-)
+    # 時刻情報は不要なので日付情報のみに変換
+    df["date"] = pd.to_datetime(df.start_time).apply(
+        lambda d: datetime(d.year, d.month, d.day)
+    )
 
-# PROGRAM_LISTで設定されていない番組を削除
-df = df[df.kouza.notna()]
+    # PROGRAM_LISTで設定されていない番組を削除
+    df = df[df.kouza.notna()]
 
-# 先週-先々週放送された番組タイトルのリストを取得
-conn = sqlite3.connect(DB_FILE)
-sql = 'SELECT title FROM programs WHERE date BETWEEN "{}" and "{}"'.format(
-    (datetime.today() + relativedelta(days=-13)).strftime("%Y-%m-%d"),
-    datetime.today().strftime("%Y-%m-%d"),
-)
-titles_lastweek = pd.read_sql(sql, conn).title.to_list()
-conn.close()
-# 先週放送された番組と同じタイトルの番組（再放送）は削除
-df = df.loc[~df.title.isin(titles_lastweek), :]
+with profiler.stage("dedupe"):
+    # 先週-先々週放送された番組タイトルのリストを取得
+    conn = sqlite3.connect(DB_FILE)
+    sql = 'SELECT title FROM programs WHERE date BETWEEN "{}" and "{}"'.format(
+        (datetime.today() + relativedelta(days=-13)).strftime("%Y-%m-%d"),
+        datetime.today().strftime("%Y-%m-%d"),
+    )
+    titles_lastweek = pd.read_sql(sql, conn).title.to_list()
+    conn.close()
+    # 先週放送された番組と同じタイトルの番組（再放送）は削除
+    df = df.loc[~df.title.isin(titles_lastweek), :]
 
-# 放送時間で並べ替えて同一タイトルの重複行を削除（同じ週の再放送の削除）
-df = df.sort_values(["start_time", "title"])
-df = df.drop_duplicates("title").drop_duplicates(["date", "kouza"]).reset_index()
+    # 放送時間で並べ替えて同一タイトルの重複行を削除（同じ週の再放送の削除）
+    df = df.sort_values(["start_time", "title"])
+    df = df.drop_duplicates("title").drop_duplicates(["date", "kouza"]).reset_index()
 
 # データベースファイルに追加する
-df = df.loc[:, ["date", "title", "artist", "kouza"]]
-logger.info("inserted prgrams = {}, records = {}".format(df.kouza.nunique(), len(df)))
-conn = sqlite3.connect(DB_FILE)
-df.to_sql("programs", conn, index=False, if_exists="append")
-conn.close()
+with profiler.stage("insert"):
+    df = df.loc[:, ["date", "title", "artist", "kouza"]]
+    logger.info("inserted prgrams = {}, records = {}".format(df.kouza.nunique(), len(df)))
+    conn = sqlite3.connect(DB_FILE)
+    df.to_sql("programs", conn, index=False, if_exists="append")
+    conn.close()
+
+profiler.write_report()
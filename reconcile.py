@@ -0,0 +1,156 @@
+"""
+一時ディレクトリ(TMPOUTDIR)に暫定タグで保存された番組のうち、
+番組表データベースに番組情報が追加されたものを正しいアルバムへ移動する
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sqlite3
+from datetime import datetime
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from mutagen.mp4 import MP4
+
+from fingerprint import update_fingerprint_path
+from lease import HOSTNAME, course_lease
+from nhkstream import get_img_file, get_textbook_volume, get_total_track_num, settag
+from settings import DB_FILE, KOUZALIST, OUTBASEDIR, TMPBASEDIR, TMPOUTDIR
+from util import FILENAME_PATTERN, dict_factory, move_file
+
+logger = logging.getLogger("reconcile")
+
+
+def index_tmpoutdir(tmpoutdir: Path) -> List[Tuple[str, datetime, Path]]:
+    """一時ディレクトリのファイルを(講座名, 放送日, ファイルパス)のリストにする"""
+    index = []
+    for file in tmpoutdir.glob("*.m4a"):
+        m = FILENAME_PATTERN.match(file.name)
+        if m is None:
+            continue
+        index.append((m.group("kouza"), datetime.strptime(m.group("date"), "%Y_%m_%d"), file))
+    return sorted(index, key=lambda x: (x[0], x[1]))
+
+
+def find_programs(kouza_list: Set[str]) -> Dict[Tuple[str, str], Dict[str, str]]:
+    """講座の番組情報を一括で取得して(講座名, 放送日)をキーとする辞書にする"""
+    if len(kouza_list) == 0:
+        return {}
+    con = sqlite3.connect(DB_FILE)
+    con.row_factory = dict_factory
+    cur = con.cursor()
+    cur.execute(
+        "SELECT kouza, date, title, artist FROM programs WHERE kouza IN ({})".format(
+            ",".join("?" * len(kouza_list))
+        ),
+        tuple(kouza_list),
+    )
+    programs = {(row["kouza"], str(row["date"])[:10]): row for row in cur.fetchall()}
+    con.close()
+    return programs
+
+
+def renumber_tracks(albumdir: Path, total_track_num: int) -> None:
+    """アルバムのトラック番号を放送日順に振り直す"""
+    for i, audiofile in enumerate(sorted(albumdir.glob("*.m4a"))):
+        trkn = MP4(audiofile).tags.get("trkn")
+        if trkn != [(i + 1, total_track_num)]:
+            settag(audiofile, track_num=i + 1, total_track_num=total_track_num)
+
+
+def reconcile_kouza(
+    kouzaname: str,
+    index: List[Tuple[str, datetime, Path]],
+    programs: Dict[Tuple[str, str], Dict[str, str]],
+    textbook_id_format: str | None,
+    imgdir: Path,
+    dry_run: bool = False,
+) -> int:
+    """1講座分のファイルをアルバムへ移動し、移動先のアルバム数を返す"""
+    img_files: Dict[Tuple[int, int], Path | None] = {}
+    albums: Dict[Path, int] = {}
+
+    for _, date, tmpfile in index:
+        program = programs.get((kouzaname, f"{date:%Y-%m-%d}"))
+        if program is None:
+            continue
+
+        total_track_num = get_total_track_num(kouzaname, date.month)
+        textbook_year, textbook_month = get_textbook_volume(kouzaname, date, total_track_num)
+        total_track_num = get_total_track_num(kouzaname, textbook_month)
+        OUTDIR = OUTBASEDIR / kouzaname / f"{textbook_year:d}年{textbook_month:02d}月号"
+        albumname = f"{kouzaname}{textbook_year:d}年{textbook_month:02d}月号"
+        audiofile = OUTDIR / tmpfile.name
+
+        if audiofile.is_file():
+            logger.info(f"{albumname}:{audiofile.name}は取得済みのため一時ファイルを削除します")
+            if not dry_run:
+                tmpfile.unlink()
+            continue
+
+        logger.info(f"{tmpfile.name} -> {albumname}:{program['title']}")
+        if dry_run:
+            continue
+
+        key = (textbook_year, textbook_month)
+        if key not in img_files:
+            img_files[key] = get_img_file(textbook_year, textbook_month, textbook_id_format, imgdir)
+
+        # タグを設定してからアルバムへ移動する
+        settag(
+            tmpfile,
+            image=img_files[key],
+            title=program["title"],
+            artist=program["artist"],
+            album=albumname,
+            genre="Speech",
+            year=textbook_year,
+            disc_num=1,
+            total_disc_num=1,
+        )
+        OUTDIR.mkdir(parents=True, exist_ok=True)
+        move_file(tmpfile, audiofile)
+        update_fingerprint_path(tmpfile, audiofile)
+        albums[OUTDIR] = total_track_num
+
+    # 移動先のアルバムのトラック番号をまとめて振り直す
+    for albumdir, total_track_num in albums.items():
+        renumber_tracks(albumdir, total_track_num)
+
+    return len(albums)
+
+
+def reconcile(dry_run: bool = False) -> None:
+    index = index_tmpoutdir(TMPOUTDIR)
+    programs = find_programs({kouza for kouza, _, _ in index})
+    textbook_id_formats = {kouzaname: booknum for kouzaname, _, booknum, _ in KOUZALIST}
+
+    imgdir = TMPBASEDIR / "reconcile" / HOSTNAME
+    imgdir.mkdir(parents=True, exist_ok=True)
+
+    album_count = 0
+    for kouzaname, entries in groupby(index, key=lambda x: x[0]):
+        # アルバムのトラック番号が衝突しないよう講座のリースを取得してから移動する
+        with course_lease(kouzaname) as lease:
+            if lease is None:
+                logger.info(kouzaname + "は他のホストで処理中のためスキップ")
+                continue
+            album_count += reconcile_kouza(
+                kouzaname, list(entries), programs, textbook_id_formats.get(kouzaname), imgdir, dry_run=dry_run
+            )
+
+    logger.info(f"reconciled albums = {album_count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="reconcile",
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--dry-run", action="store_true", help="移動せずに対象ファイルを表示する")
+    args = parser.parse_args()
+
+    reconcile(dry_run=args.dry_run)
@@ -1,71 +1,249 @@
-import re
+"""
+番組表データベースの欠落した放送日のレコードを前後の番組から補完する
+
+期間を指定しなければ、KOUZALISTのどの講座のレコードもない放送日(番組表を取得できなかった日)だけを
+補完する。期間を指定すると、その期間の講座ごとに欠落した放送日を補完する。
+programdbは再放送のレコードを追加しないので、欠落した放送日の前後の番組のタイトル番号が
+放送回数だけ進んでいなければ再放送があったとみなして補完しない
+
+補完する番組は同じ曜日の最も近い放送日の番組のタイトル番号を講座ごとの規則でずらして追加する
+"""
+from __future__ import annotations
+
+import argparse
 import sqlite3
+import sys
 from datetime import datetime
+from typing import List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from dateutil.relativedelta import MO, relativedelta
 
-from settings import DB_FILE
-
-
-def get_func(nums):
-    def func(rec):
-        rec["date"] = pd.to_datetime(rec.date) + relativedelta(weeks=1)
-        if rec.kouza == "英会話タイムトライアル":
-            m = re.search(r"DAY(?P<day>[0-9]+)", rec.title)
-            if m:
-                rec.title = rec.title.replace(
-                    "DAY{}".format(m.group("day")),
-                    "DAY{}".format(int(m.group("day")) + nums),
-                )
-        elif rec.kouza == "高校生からはじめる「現代英語」":
-            m = re.search(r"Lesson(?P<num>[0-9]+) Part(?P<part>[0-9+])", rec.title)
-            if m:
-                rec.title = rec.title.replace(
-                    m.group("num"), str(int(m.group("num")) + 1)
-                )
-        else:
-            m = re.search(r"\((?P<num>[0-9]+)\)", rec.title)
-            if m:
-                rec.title = rec.title.replace(
-                    m.group("num"), str(int(m.group("num")) + nums)
-                )
-        return rec
-
-    return func
-
-
-def sql_one_week(mon: datetime) -> str:
-    return 'SELECT * FROM programs WHERE date BETWEEN "{}" and "{}"'.format(
-        mon.strftime("%Y-%m-%d"), (mon + relativedelta(days=6)).strftime("%Y-%m-%d")
+from settings import DB_FILE, KOUZALIST
+
+# タイトルの番号の規則 (講座名, 正規表現, 単位)
+#  講座名がNoneの規則はほかに該当する規則がない講座に適用する
+#  正規表現は番号の前(pre)・番号(num)・番号の後(post)のグループを持つ
+#  単位は放送1回ごとに番号が増えるなら"episode"、1週ごとに増えるなら"week"
+NUMBERING_RULES: List[Tuple[Optional[str], str, str]] = [
+    ("英会話タイムトライアル", r"^(?P<pre>.*?DAY)(?P<num>[0-9]+)(?P<post>.*)$", "episode"),
+    ("高校生からはじめる「現代英語」", r"^(?P<pre>.*?Lesson)(?P<num>[0-9]+)(?P<post>.*)$", "week"),
+    (None, r"^(?P<pre>.*?\()(?P<num>[0-9]+)(?P<post>\).*)$", "episode"),
+]
+
+
+def weekmask(weekdays: List[int]) -> str:
+    """放送曜日(月曜=1)をnumpyのweekmask形式にする"""
+    return "".join("1" if i in weekdays else "0" for i in range(1, 8))
+
+
+def count_advance(kouza: pd.Series, start: pd.Series, end: pd.Series, unit: pd.Series) -> pd.Series:
+    """startからendまでにタイトル番号が進む数(単位が"episode"なら放送回数、"week"なら週数)"""
+    weekdays = {kouzaname: weekdays for kouzaname, _, _, weekdays in KOUZALIST}
+    advance = pd.Series(0, index=kouza.index)
+    for kouzaname, idx in kouza.groupby(kouza).groups.items():
+        advance.loc[idx] = np.busday_count(
+            start.loc[idx].to_numpy().astype("datetime64[D]"),
+            end.loc[idx].to_numpy().astype("datetime64[D]"),
+            weekmask=weekmask(weekdays[kouzaname]),
+        )
+    # 週数は月曜日を週の始まりとして数える
+    end_monday = end - pd.to_timedelta(end.dt.weekday, unit="D")
+    start_monday = start - pd.to_timedelta(start.dt.weekday, unit="D")
+    weeks = (end_monday - start_monday).dt.days // 7
+    return advance.where(unit == "episode", weeks)
+
+
+def parse_titles(programs: pd.DataFrame) -> pd.DataFrame:
+    """タイトルを講座の規則で番号の前(pre)・番号(num)・番号の後(post)に分け、単位(unit)を付ける"""
+    parts = pd.DataFrame(index=programs.index, columns=["pre", "num", "post", "unit"], dtype=object)
+    specific = {kouza for kouza, _, _ in NUMBERING_RULES if kouza is not None}
+    for kouza, pattern, unit in NUMBERING_RULES:
+        mask = programs.kouza == kouza if kouza is not None else ~programs.kouza.isin(specific)
+        if not mask.any():
+            continue
+        extracted = programs.loc[mask, "title"].str.extract(pattern)
+        parts.loc[mask, ["pre", "num", "post"]] = extracted[["pre", "num", "post"]]
+        parts.loc[mask, "unit"] = unit
+    parts["num"] = pd.to_numeric(parts.num)
+    return parts
+
+
+def expected_programs(start: datetime, end: datetime) -> pd.DataFrame:
+    """期間内にKOUZALISTの放送曜日に放送されたはずの(講座名, 放送日)"""
+    dates = pd.date_range(start, end, freq="D")
+    return pd.concat(
+        [
+            pd.DataFrame({"kouza": kouzaname, "date": dates[dates.isocalendar().day.isin(weekdays).to_numpy()]})
+            for kouzaname, _, _, weekdays in KOUZALIST
+        ],
+        ignore_index=True,
+    ).drop_duplicates()
+
+
+def find_gaps(known: pd.DataFrame, start: datetime, end: datetime, outage_only: bool = True) -> pd.DataFrame:
+    """
+    データベースにない番組を探し、同じ曜日の最も近い放送日の番組を対応付ける
+
+    outage_onlyならどの講座のレコードもない放送日だけを対象にする
+    """
+    expected = expected_programs(start, end)
+    if outage_only:
+        expected = expected[~expected.date.isin(known.date)]
+    # 講座の最初の放送日より前は補完しない
+    first_dates = known.groupby("kouza").date.min().rename("first_date")
+    expected = expected.join(first_dates, on="kouza", how="inner")
+    expected = expected[expected.date >= expected.first_date].drop(columns="first_date")
+
+    gaps = expected.merge(known[["kouza", "date"]], on=["kouza", "date"], how="left", indicator=True)
+    gaps = gaps[gaps._merge == "left_only"].drop(columns="_merge")
+    if len(gaps) == 0:
+        return gaps
+
+    gaps["weekday"] = gaps.date.dt.weekday
+    sources = known.rename(columns={"date": "source_date"}).assign(weekday=known.date.dt.weekday)
+    gaps = pd.merge_asof(
+        gaps.sort_values("date"),
+        sources.sort_values("source_date"),
+        left_on="date",
+        right_on="source_date",
+        by=["kouza", "weekday"],
+        direction="nearest",
     )
+    return gaps[gaps.source_date.notna()].drop(columns="weekday").reset_index(drop=True)
+
 
+def drop_reruns(gaps: pd.DataFrame, known: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    欠落した放送日の直前と直後の番組のタイトル番号を比べ、放送回数だけ進んでいない区間の番組を除く
 
-# 先々週放送された番組タイトルのリストを取得
-with sqlite3.connect(DB_FILE) as conn:
-    # 先週月曜日
-    mon_last_week = datetime.today() + relativedelta(
-        weeks=-1, weekday=MO(-1), hour=0, minute=0, second=0, microsecond=0
+    番号が進んでいなければその区間には再放送があり、取得できなかった新しい放送回はない。
+    直前か直後の番組がない場合や番号がない場合は判定できないので除かない。
+    直前の番組の放送日と番号(prev_date, prev_num)を付けて(補完する番組, 除いた番組)を返す
+    """
+    if len(gaps) == 0:
+        return gaps, gaps
+    numbered = known[["kouza", "date"]].join(parse_titles(known)[["num", "unit"]])
+    numbered = numbered[numbered.num.notna()].sort_values("date")
+
+    spans = gaps[["kouza", "date"]].reset_index().sort_values("date")
+    for direction, suffix in [("backward", "prev"), ("forward", "next")]:
+        spans = pd.merge_asof(
+            spans,
+            numbered.rename(columns={"date": f"{suffix}_date", "num": f"{suffix}_num", "unit": f"{suffix}_unit"}),
+            left_on="date",
+            right_on=f"{suffix}_date",
+            by="kouza",
+            direction=direction,
+        )
+    spans = spans.set_index("index").reindex(gaps.index)
+
+    checkable = spans.prev_num.notna() & spans.next_num.notna()
+    expected = count_advance(
+        spans.kouza[checkable], spans.prev_date[checkable], spans.next_date[checkable], spans.prev_unit[checkable]
     )
-    # 先々週の月曜日
-    mon_the_week_befor_last = mon_last_week + relativedelta(weeks=-1)
-
-    if len(pd.read_sql(sql_one_week(mon_last_week), conn)) > 0:
-        print("先週放送された番組のレコードが残っています．削除してから実行してください．")
-    else:
-        df_bfrlstweek = pd.read_sql(sql_one_week(mon_the_week_befor_last), conn)
-
-        # タイトルと日付を変更して取得できなかった先週分を強制的に追加
-        # 英会話タイムトライアルと現代英語はタイトルの規則性が弱いので確認してDBを変更する
-        for _, gr in df_bfrlstweek.groupby("kouza"):
-            func = get_func(len(gr))
-            gr = gr.apply(func, axis=1)
-            gr.to_sql("programs", conn, index=False, if_exists="append")
-
-        # 追加されたレコードの確認
-        df_lstweek = pd.read_sql(sql_one_week(mon_last_week), conn)
-        print(
-            "追加されたレコード：{}, 追加された番組：{}".format(
-                len(df_lstweek), len(df_lstweek.kouza.unique())
-            )
+    actual = spans.next_num[checkable] - spans.prev_num[checkable]
+    rerun = pd.Series(False, index=gaps.index)
+    rerun[checkable] = actual != expected
+    gaps = gaps.assign(prev_date=spans.prev_date, prev_num=spans.prev_num)
+    return gaps[~rerun], gaps[rerun]
+
+
+def synthesize(gaps: pd.DataFrame) -> pd.DataFrame:
+    """
+    対応付けた番組のタイトルの番号を付け替える
+
+    番号は直前の番組の番号から放送日の差だけ進める。直前の番組がなければ対応付けた番組から数える
+    """
+    if len(gaps) == 0:
+        return gaps
+    base = gaps[["prev_date", "prev_num"]]
+    gaps = gaps.drop(columns=["prev_date", "prev_num"])
+    parts = parse_titles(gaps)
+    parts = parts[parts.num.notna()]
+    if len(parts) == 0:
+        return gaps
+
+    # 放送回数の差または週数の差だけ番号を進める
+    base_date = base.prev_date[parts.index].fillna(gaps.source_date[parts.index])
+    base_num = base.prev_num[parts.index].fillna(parts.num)
+    offset = count_advance(gaps.kouza[parts.index], base_date, gaps.date[parts.index], parts.unit)
+    gaps.loc[parts.index, "title"] = parts.pre + (base_num.astype(int) + offset).astype(str) + parts.post
+    return gaps
+
+
+def read_programs() -> pd.DataFrame:
+    kouza_list = [kouzaname for kouzaname, _, _, _ in KOUZALIST]
+    with sqlite3.connect(DB_FILE) as conn:
+        known = pd.read_sql(
+            "SELECT date, title, artist, kouza FROM programs WHERE kouza IN ({})".format(
+                ",".join("?" * len(kouza_list))
+            ),
+            conn,
+            params=kouza_list,
+        )
+    conn.close()
+    known["date"] = pd.to_datetime(known.date).dt.normalize()
+    return known.drop_duplicates(["kouza", "date"])
+
+
+def insert_programs(rows: pd.DataFrame) -> None:
+    """補完したレコードを1トランザクションで追加する"""
+    with sqlite3.connect(DB_FILE) as conn:
+        conn.executemany(
+            "INSERT INTO programs (date, title, artist, kouza) VALUES (?, ?, ?, ?)",
+            zip(rows.date.dt.strftime("%Y-%m-%d %H:%M:%S"), rows.title, rows.artist, rows.kouza),
         )
+    conn.close()
+
+
+if __name__ == "__main__":
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    parser = argparse.ArgumentParser(
+        prog="recoverdb",
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--start",
+        type=datetime.fromisoformat,
+        help="補完する期間の開始日 YYYY-MM-DD (省略すると4週前の月曜日からの番組表を取得できなかった日だけを補完する)",
+    )
+    parser.add_argument(
+        "--end",
+        type=datetime.fromisoformat,
+        help="補完する期間の終了日 YYYY-MM-DD (デフォルトは昨日)",
+    )
+    parser.add_argument("--dry-run", action="store_true", help="追加するレコードを表示するだけで追加しない")
+    parser.add_argument("-y", "--yes", action="store_true", help="確認せずに追加する")
+    args = parser.parse_args()
+
+    # 期間を指定しなければ番組表を取得できなかった日だけを補完する
+    outage_only = args.start is None and args.end is None
+    start = args.start if args.start is not None else today + relativedelta(weeks=-4, weekday=MO(-1))
+    end = args.end if args.end is not None else today + relativedelta(days=-1)
+
+    known = read_programs()
+    gaps, reruns = drop_reruns(find_gaps(known, start, end, outage_only=outage_only), known)
+    for row in reruns.sort_values(["kouza", "date"]).itertuples():
+        print(f"{row.date:%Y-%m-%d} {row.kouza} は前後の番組の番号が進んでいないため再放送とみなして補完しません")
+    rows = synthesize(gaps)
+    if len(rows) == 0:
+        print("補完するレコードはありません．")
+        sys.exit()
+
+    # 英会話タイムトライアルと現代英語はタイトルの規則性が弱いので確認してから追加する
+    for row in rows.sort_values(["kouza", "date"]).itertuples():
+        print(f"{row.date:%Y-%m-%d} {row.kouza} {row.title} (元: {row.source_date:%Y-%m-%d})")
+    print(f"追加するレコード：{len(rows)}, 番組：{rows.kouza.nunique()}")
+    if args.dry_run:
+        sys.exit()
+    if not args.yes:
+        print("追加しますか(y/n)")
+        if input().strip() != "y":
+            sys.exit()
+
+    insert_programs(rows)
+    print("追加しました．")
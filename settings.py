@@ -59,6 +59,18 @@ TMPOUTDIR: Path = Path(os.environ.get("TMPOUTDIR", default=BASEDIR / "Music" / "
 # 作業ディレクトリ
 TMPBASEDIR: Path = Path(os.environ.get("TMPBASEDIR", default=BASEDIR / "tmp"))
 
+# 追加で変換する音声フォーマットのリスト(空なら変換しない)
+#  (拡張子, ffmpegのエンコーダ名, ビットレート)
+#  例: ("mp3", "libmp3lame", "128k"), ("opus", "libopus", "32k")
+TRANSCODE_FORMATS: List[Tuple[str, str, str]] = []
+# 変換したファイルの出力ディレクトリ
+TRANSCODE_BASEDIR: Path = Path(os.environ.get("TRANSCODE_BASEDIR", default=BASEDIR / "Music" / "NHK_transcoded"))
+
+# 複数ホストで分担してダウンロードする場合のリースファイルを置く共有ディレクトリ(未設定なら単独で実行)
+LEASE_DIR: Optional[Path] = Path(os.environ["LEASE_DIR"]) if "LEASE_DIR" in os.environ else None
+# リースの有効期限(秒)。期限の1/3ごとに更新し、更新が途絶えたリースは他のホストが取得できる
+LEASE_TTL: int = int(os.environ.get("LEASE_TTL", default=15 * 60))
+
 # rtmpdumpとffmpegのコマンド
 if os.name == "nt":
     # Windowsの場合
@@ -69,10 +81,23 @@ if os.name == "nt":
 else:
     ffmpeg = "ffmpeg"
 
+# ダウンロードしたファイルを作業ディレクトリに書き出さず、メモリ上でタグを設定してから保存先に1回だけ書き込む
+STAGING_IN_MEMORY: bool = os.environ.get("STAGING_IN_MEMORY", default="0") == "1"
+# メモリ上に受け取るファイルのサイズの上限(バイト)。達した場合は作業ディレクトリのファイルに出力し直す
+STAGING_MEMORY_CAP: int = int(os.environ.get("STAGING_MEMORY_CAP", default=64 * 1024 * 1024))
+
 # 番組表データベースを使用してmp3ファイルのタグを設定するかどうか
 USE_DB_TAG: bool = True
 # 番組表データベースファイルパス
 DB_FILE: Path = Path(os.environ.get("DB_FILE", default=BASEDIR / "program.db"))
+# 実行状況を記録するジャーナルファイルパス(番組表データベースと同じディレクトリに置く)
+JOURNAL_FILE: Path = Path(os.environ.get("JOURNAL_FILE", default=DB_FILE.parent / "journal.db"))
+# 聴き逃し配信は放送から約1週間なので、放送日からこの日数が過ぎた未完了の番組は再開せずジャーナルから削除する
+JOURNAL_EXPIRE_DAYS: int = int(os.environ.get("JOURNAL_EXPIRE_DAYS", default=14))
+# 重複ダウンロード判定のためにフィンガープリントを取る区間(番組開始からの秒数と長さ)
+# 番組冒頭のテーマ曲は講座内で共通なので避ける。長さを0にすると判定しない
+FINGERPRINT_OFFSET: int = int(os.environ.get("FINGERPRINT_OFFSET", default=240))
+FINGERPRINT_SECONDS: int = int(os.environ.get("FINGERPRINT_SECONDS", default=20))
 # NHK番組表APIで取得される番組名と講座名の対応表
 # 講座名はファイル名に使用するため空白が含まれない形式にする必要があり変換テーブルが必要
 PROGRAMLIST: List[Tuple[str, str]] = [
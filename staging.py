@@ -0,0 +1,91 @@
+"""
+ffmpegの出力をメモリ上に受け取り、タグを設定してから保存先に1回だけ書き込む
+
+ffmpegにはmemfd_createで作ったメモリ上のファイルを/proc/self/fd/Nとして渡すので、
+作業ディレクトリに出力する場合と同じくシーク可能な通常のMP4になる。
+出力がSTAGING_MEMORY_CAPに達した場合やmemfd_createを使えない環境では
+作業ディレクトリのファイルに出力し直す
+"""
+from __future__ import annotations
+
+import os
+import shutil
+from pathlib import Path
+from subprocess import DEVNULL, check_call
+from typing import BinaryIO, List, Optional
+
+from settings import STAGING_MEMORY_CAP
+from util import move_file
+
+
+class StagingBuffer:
+    def __init__(self, spill_path: Path, cap: int = STAGING_MEMORY_CAP):
+        # メモリ上に受け取れないときに出力する作業ディレクトリのファイル
+        self.spill_path = spill_path
+        self.cap = cap
+        self.file: Optional[BinaryIO] = None
+        self.spilled = False
+
+    @property
+    def size(self) -> int:
+        assert self.file is not None
+        return os.fstat(self.file.fileno()).st_size
+
+    def fileobj(self) -> BinaryIO:
+        """タグの設定に使うファイルオブジェクト"""
+        assert self.file is not None
+        self.file.seek(0)
+        return self.file
+
+    def _ffmpeg(self, cmd_args: List[str], output: str, timeout: float, pass_fds=()) -> None:
+        check_call(
+            cmd_args + ["-f", "mp4", output],
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+            timeout=timeout,
+            pass_fds=pass_fds,
+        )
+
+    def run(self, cmd_args: List[str], timeout: float) -> None:
+        """ffmpegの出力をバッファに受け取る。失敗したらcheck_callと同じ例外を送出する"""
+        self.clear()
+        if hasattr(os, "memfd_create") and self.cap > 0:
+            self.file = os.fdopen(os.memfd_create("nhkstream"), "w+b")
+            fd = self.file.fileno()
+            # -fsで上限に達したところで出力を打ち切らせるので、メモリ上のファイルは上限を大きく超えない
+            self._ffmpeg(cmd_args + ["-fs", str(self.cap)], f"/proc/self/fd/{fd}", timeout, pass_fds=(fd,))
+            if self.size < self.cap:
+                return
+            # 上限に達して打ち切られたので作業ディレクトリのファイルに出力し直す
+            self.clear()
+        # mkstempは0600で作成するので、保存先で他のユーザーも読めるようumaskに従うopen()で作成する
+        self.file = open(self.spill_path, "w+b")
+        self.spilled = True
+        self._ffmpeg(cmd_args, str(self.spill_path), timeout)
+
+    def save(self, dst: Path) -> None:
+        """保存先に書き込む。書き込み途中のファイルが見えないよう一時ファイル経由で置き換える"""
+        assert self.file is not None
+        if self.spilled:
+            self.file.close()
+            move_file(self.spill_path, dst)
+            self.spilled = False
+            self.file = None
+            return
+        partfile = dst.with_name(dst.name + ".part")
+        self.file.seek(0)
+        with open(partfile, "wb") as f:
+            shutil.copyfileobj(self.file, f)
+        os.replace(partfile, dst)
+
+    def clear(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.spilled:
+            if self.spill_path.exists():
+                self.spill_path.unlink()
+            self.spilled = False
+
+    def close(self) -> None:
+        self.clear()
@@ -0,0 +1,164 @@
+"""
+保存済みのm4aファイルをTRANSCODE_FORMATSで設定したフォーマットに変換する
+
+変換先のファイルがないか元ファイルより古いものだけを、CPUコア数のプロセスで並列に変換する
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from subprocess import DEVNULL, STDOUT, CalledProcessError, TimeoutExpired, check_call
+from typing import List, Tuple
+
+from mutagen import MutagenError
+from mutagen.flac import Picture
+from mutagen.id3 import APIC, ID3, TALB, TCON, TDRC, TIT2, TPE1, TPE2, TPOS, TRCK
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
+
+from settings import OUTBASEDIR, TRANSCODE_BASEDIR, TRANSCODE_FORMATS, ffmpeg
+
+logger = logging.getLogger("transcode")
+
+
+def get_outfile(mp4file: Path, ext: str, bitrate: str) -> Path:
+    return TRANSCODE_BASEDIR / f"{ext}_{bitrate}" / mp4file.relative_to(OUTBASEDIR).with_suffix("." + ext)
+
+
+def copytag(mp4file: Path, outfile: Path) -> None:
+    """m4aファイルのタグとジャケット画像を変換したファイルに設定する"""
+    tags = MP4(mp4file).tags or {}
+
+    def first(key):
+        values = tags.get(key)
+        return values[0] if values else None
+
+    title = first("\xa9nam")
+    album = first("\xa9alb")
+    artist = first("\xa9ART")
+    album_artist = first("aART")
+    genre = first("\xa9gen")
+    year = first("\xa9day")
+    trkn = first("trkn")
+    disk = first("disk")
+    covr = first("covr")
+
+    if outfile.suffix == ".mp3":
+        audio = ID3()
+        for frame, value in [
+            (TIT2, title),
+            (TALB, album),
+            (TPE1, artist),
+            (TPE2, album_artist),
+            (TCON, genre),
+            (TDRC, year),
+        ]:
+            if value is not None:
+                audio.add(frame(encoding=3, text=value))
+        if trkn is not None:
+            audio.add(TRCK(encoding=3, text="{}/{}".format(*trkn)))
+        if disk is not None:
+            audio.add(TPOS(encoding=3, text="{}/{}".format(*disk)))
+        if covr is not None:
+            audio.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=bytes(covr)))
+        audio.save(outfile)
+    elif outfile.suffix in (".opus", ".ogg"):
+        audio = OggOpus(outfile)
+        for key, value in [
+            ("title", title),
+            ("album", album),
+            ("artist", artist),
+            ("albumartist", album_artist),
+            ("genre", genre),
+            ("date", year),
+        ]:
+            if value is not None:
+                audio[key] = value
+        if trkn is not None:
+            audio["tracknumber"], audio["tracktotal"] = str(trkn[0]), str(trkn[1])
+        if disk is not None:
+            audio["discnumber"], audio["disctotal"] = str(disk[0]), str(disk[1])
+        if covr is not None:
+            picture = Picture()
+            picture.type = 3
+            picture.mime = "image/jpeg"
+            picture.data = bytes(covr)
+            audio["metadata_block_picture"] = base64.b64encode(picture.write()).decode("ascii")
+        audio.save()
+    else:
+        # m4a等のMP4コンテナはタグをそのままコピーする
+        audio = MP4(outfile)
+        audio.tags = MP4(mp4file).tags
+        audio.save()
+
+
+def transcode(mp4file: Path, outfile: Path, codec: str, bitrate: str) -> Path:
+    """1ファイルを変換する。プロセスプールのワーカーで実行される"""
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    partfile = outfile.with_name(outfile.stem + ".part" + outfile.suffix)
+    cmd_args = [
+        ffmpeg,
+        "-y",
+        "-i",
+        str(mp4file),
+        "-vn",
+        "-map_metadata",
+        "-1",
+        "-acodec",
+        codec,
+        "-b:a",
+        bitrate,
+        str(partfile),
+    ]
+    try:
+        check_call(cmd_args, stdout=DEVNULL, stderr=STDOUT, timeout=10 * 60)
+        copytag(mp4file, partfile)
+        os.replace(partfile, outfile)
+    finally:
+        if partfile.exists():
+            partfile.unlink()
+    return outfile
+
+
+def find_jobs(formats: List[Tuple[str, str, str]]) -> List[Tuple[Path, Path, str, str]]:
+    """変換先がないか元ファイルより古いファイルを変換対象とする"""
+    jobs = []
+    for mp4file in sorted(OUTBASEDIR.glob("*/*/*.m4a")):
+        for ext, codec, bitrate in formats:
+            outfile = get_outfile(mp4file, ext, bitrate)
+            if outfile.is_file() and outfile.stat().st_mtime >= mp4file.stat().st_mtime:
+                continue
+            jobs.append((mp4file, outfile, codec, bitrate))
+    return jobs
+
+
+def transcode_all(formats: List[Tuple[str, str, str]], max_workers: int | None = None) -> None:
+    jobs = find_jobs(formats)
+    logger.info(f"transcode jobs = {len(jobs)}")
+    if len(jobs) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {executor.submit(transcode, *job): job for job in jobs}
+        for future in as_completed(futures):
+            mp4file, outfile, _, _ = futures[future]
+            try:
+                future.result()
+                logger.info(f"変換完了：{outfile.relative_to(TRANSCODE_BASEDIR)}")
+            except (CalledProcessError, TimeoutExpired, OSError, MutagenError) as e:
+                logger.error(f"{mp4file.name}の変換に失敗しました：{e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="transcode",
+        description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--workers", type=int, default=None, help="並列数(デフォルトはCPUコア数)")
+    args = parser.parse_args()
+
+    transcode_all(TRANSCODE_FORMATS, max_workers=args.workers)
@@ -1,5 +1,12 @@
+import errno
+import os
+import re
+import shutil
 import sys
 
+# 保存するファイル名の形式 {講座名}_{放送日 YYYY_MM_DD}.m4a
+FILENAME_PATTERN = re.compile(r"^(?P<kouza>.+)_(?P<date>[0-9]{4}_[0-9]{2}_[0-9]{2})\.m4a$")
+
 
 # UTF-8以外の環境で生じるユニコード問題への対処関数
 def encodecmd(cmd):
@@ -16,3 +23,17 @@ def dict_factory(cursor, row):
     for idx, col in enumerate(cursor.description):
         d[col[0]] = row[idx]
     return d
+
+
+# ファイルを移動する。同一ファイルシステム内ならrenameで、異なる場合は移動先に一時ファイルとして
+# コピーしてからrenameするので、移動先に書きかけのファイルが見えることはない
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = "{}.part".format(dst)
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        os.unlink(src)